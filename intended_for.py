@@ -1,8 +1,30 @@
 #! /usr/bin/env python3
 
-import os, sys, argparse, json
-from bids import BIDSLayout
-from itertools import product
+import os, re, sys, argparse, json, multiprocessing, shutil, tempfile
+from bisect import bisect_left
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import chain
+
+# orjson is optional; it parses the sidecars much faster than the stdlib json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _loads(raw):
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than the stdlib, e.g. it rejects NaN, so let json decide
+            pass
+    return json.loads(raw)
+
+def _dumps(data):
+    # Always serialized by the stdlib so the sidecars on disk do not depend on whether orjson is installed
+    return json.dumps(data, indent=4).encode()
 
 # Last modified
 last_modified = "Adapted from work by Anders Perrone 3/21/2017. Last modified 11/18/2022"
@@ -69,44 +91,49 @@ class FieldmapPairing(object):
       
     def group_fmap_by_run(self):
         # Pair all fmaps by run number
-        fmap_runs = {}
+        fmap_runs = defaultdict(list)
         for f in self.fmap:
             # TODO: Handle case where there is only one run
-            try:
-                f_run = f.get_entities()['run']
-            except:
-                f_run = 1
-            if f_run in fmap_runs:
-                fmap_runs[f_run].append(f)
-            else:
-                fmap_runs[f_run] = [f]
+            fmap_runs[f.get_entities().get('run', 1)].append(f)
 
         for run_number, fieldmap_pairs in fmap_runs.items():
-            try:
-                assert(len(fieldmap_pairs) == 2)
-            except AssertionError:
+            if len(fieldmap_pairs) != 2:
                 sys.exit('Unpaired fieldmaps for {} {}'.format(self.subject, self.session))
 
-        return fmap_runs
+        return dict(fmap_runs)
 
     def pair_by_eta_squared(self):
         # TODO
         return
 
     def pair_by_task(self,skip_session=False):
+        # Query every functional image of the session once and split it by task in memory
+        if self.task is not None:
+            self.task = None
+            self.func = self.get_func(skip_session)
+        # The tasks come from the functional images themselves rather than another layout query
+        func_by_task = defaultdict(list)
+        for f in self.func:
+            func_by_task[f.get_entities()['task']].append(f)
+
+        # Likewise fetch all of the session's fieldmaps once and bucket them by acquisition (= task)
         if skip_session:
-          tasks = self.layout.get_tasks(subject=self.subject)        
+          session_fmap = self.layout.get(subject=self.subject, datatype='fmap', extension='.json')
         else:
-          tasks = self.layout.get_tasks(subject=self.subject, session=self.session)
-        for task in tasks:
+          session_fmap = self.layout.get(subject=self.subject, session=self.session, datatype='fmap', extension='.json')
+        fmap_by_task = defaultdict(list)
+        for f in session_fmap:
+            fmap_by_task[f.get_entities().get('acquisition')].append(f)
+
+        for task in sorted(func_by_task):
             self.task = task
-            self.func = self.get_func()
-            self.fmap = self.get_fmap()
+            self.func = func_by_task[task]
+            self.fmap = fmap_by_task[task]
             self.pair_by_last()
 
     def pair_by_last(self):
         fmap_runs = self.group_fmap_by_run()
-        last_fmap_pair = fmap_runs[sorted(fmap_runs.keys())[-1]]
+        last_fmap_pair = fmap_runs[max(fmap_runs)]
         func_paths = [f.path for f in self.func]
         for f in last_fmap_pair:
             self.pairing[f.path] = func_paths
@@ -116,39 +143,149 @@ class FieldmapPairing(object):
         fmap_runs = self.group_fmap_by_run()
         # Return a hash map of functional run to field maps
         # Make map of series number to pair
+        series_numbers = self.get_series_numbers(list(chain.from_iterable(fmap_runs.values())))
         fmap_series_nums = {}
         for run in fmap_runs:
-            min_series_number = min([f.get_associations()[0].get_metadata()['SeriesNumber'] for f in fmap_runs[run]])
+            min_series_number = min(series_numbers[f.path] for f in fmap_runs[run])
             fmap_series_nums[min_series_number] = [f.path for f in fmap_runs[run]]
 
-        func_series_nums = {f.get_metadata()['SeriesNumber']:f.path for f in self.func}
+        func_series_nums = {series_numbers[f.path]:f.path for f in self.func}
 
         fmap_keys = sorted(fmap_series_nums)
         func_keys = sorted(func_series_nums)
-        fmap_iter = 0
 
-        pairing = {}
         # Iterate over each functional image
         for func_key in func_keys:
-            # If the current fmap iter is at the end then insert current fmaps or if the func series number is less than the series number of the next fieldmap
-            while fmap_iter < len(fmap_keys) - 1 and func_key > fmap_keys[fmap_iter + 1]:
-                fmap_iter += 1
+            # Use the last fieldmap acquired before the functional image, or the first fieldmap if none was
+            fmap_iter = max(bisect_left(fmap_keys, func_key) - 1, 0)
             for f in fmap_series_nums[fmap_keys[fmap_iter]]:
                 self.pairing[f].append(func_series_nums[func_key])
         return
 
+    def get_series_numbers(self, fmaps):
+        # Fetch the SeriesNumber of every functional image and fieldmap in one index query
+        # The metadata is indexed on the images, so fieldmap sidecars are looked up through their image
+        image_paths = {f.path: f.path for f in self.func}
+        image_paths.update((f.path, f.path[:-len('.json')] + '.nii.gz') for f in fmaps)
+        indexed = query_series_numbers(self.layout, list(image_paths.values()))
+
+        series_numbers = {}
+        for f in chain(self.func, fmaps):
+            image_path = image_paths[f.path]
+            if image_path in indexed:
+                series_numbers[f.path] = indexed[image_path]
+            elif f.path == image_path:
+                series_numbers[f.path] = f.get_metadata()['SeriesNumber']
+            else:
+                series_numbers[f.path] = f.get_associations()[0].get_metadata()['SeriesNumber']
+        return series_numbers
+
     def insert_edit_json(self, json_path, json_field, value):
-        with open(json_path, 'r') as f:
-            data = json.load(f)
-        if json_field in data and data[json_field] != value:
-            print('WARNING: Replacing {}: {} with {} in {}'.format(json_field, data[json_field], value, json_path))
-        else:
-            print('Inserting {}: {} in {}'.format(json_field, value, json_path))
-            
-        data[json_field] = value
-        with open(json_path, 'w') as f:    
-            json.dump(data, f, indent=4)
+        # Only buffers the edit; nothing reaches the sidecar on disk until flush_json_cache() is called
+        insert_edit_json(json_path, json_field, value)
+
+# Sidecar contents keyed by path; edits are kept in memory until flush_json_cache()
+_json_cache = {}
+_dirty = set()
+_MISSING = object()
+
+def insert_edit_json(json_path, json_field, value):
+    data = _json_cache.get(json_path)
+    if data is None:
+        with open(json_path, 'rb') as f:
+            data = _loads(f.read())
+        _json_cache[json_path] = data
+    previous = data.get(json_field, _MISSING)
+    if previous == value:
+        # Already up to date, e.g. on a re-run; leave the file untouched
         return
+    if previous is not _MISSING:
+        print('WARNING: Replacing {}: {} with {} in {}'.format(json_field, previous, value, json_path))
+    else:
+        print('Inserting {}: {} in {}'.format(json_field, value, json_path))
+
+    data[json_field] = value
+    _dirty.add(json_path)
+    return
+
+def _write_json(json_path):
+    # Resolve symlinks so the link is kept and its target is what gets rewritten
+    real_path = os.path.realpath(json_path)
+    content = _dumps(_json_cache[json_path])
+    if os.stat(real_path).st_nlink > 1:
+        # Replacing the file would split it from its other hard links, so rewrite it in place
+        with open(real_path, 'wb') as f:
+            f.write(content)
+        return
+
+    # Write through a temporary file so an interrupted run never leaves a truncated json
+    tmp_path = real_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        shutil.copymode(real_path, tmp_path)
+        os.replace(tmp_path, real_path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def flush_json_cache():
+    # Write every edited sidecar once
+    # Sorted so the sidecars of one fmap directory are written back to back
+    for json_path in sorted(_dirty):
+        _write_json(json_path)
+    _dirty.clear()
+    # Nothing is reused after a flush, so do not keep the parsed sidecars alive
+    _json_cache.clear()
+    return
+
+def _get_db_session(layout):
+    # The SQLAlchemy session of the pybids index; needs pybids >= 0.14, which keeps it on the connection manager
+    return layout.connection_manager.session
+
+def query_series_numbers(layout, paths):
+    """
+    Looks up the SeriesNumber of several images with a single query against the
+    pybids metadata index instead of parsing each sidecar with get_metadata.
+    :param layout: BIDSLayout to query
+    :param paths: absolute paths of the images
+    :return: dict of path to SeriesNumber for the paths that have one indexed
+    """
+    from bids.layout import models
+
+    rows = _get_db_session(layout).query(models.Tag) \
+        .filter(models.Tag.entity_name == 'SeriesNumber', models.Tag.file_path.in_(paths))
+    return {tag.file_path: tag.value for tag in rows}
+
+def query_subject_sessions(layout):
+    """
+    Maps every subject in the layout to its session labels with a single query
+    against the pybids index instead of one get_sessions call per subject.
+    :param layout: BIDSLayout to query
+    :return: dict of subject id to sorted session ids
+    """
+    from bids.layout import models
+    from sqlalchemy import and_
+    from sqlalchemy.orm import aliased
+
+    subject_tag = aliased(models.Tag)
+    session_tag = aliased(models.Tag)
+    rows = _get_db_session(layout).query(subject_tag._value, session_tag._value) \
+        .outerjoin(session_tag, and_(session_tag.file_path == subject_tag.file_path,
+                                     session_tag.entity_name == 'session')) \
+        .filter(subject_tag.entity_name == 'subject') \
+        .distinct()
+
+    subject_sessions = {}
+    for subject, session in rows:
+        # Subjects without any session still get an (empty) entry
+        sessions = subject_sessions.setdefault(subject, set())
+        if session is not None:
+            sessions.add(session)
+    return {s: sorted(sessions) for s, sessions in sorted(subject_sessions.items())}
 
 def read_bids_layout(layout, subject_list=None, session_list=None,skip_session=False):
     """
@@ -157,28 +294,29 @@ def read_bids_layout(layout, subject_list=None, session_list=None,skip_session=F
     :param session_list: a list of session ids to filer on
     """
 
-    subjects = layout.get_subjects()
+    sessions_by_subject = query_subject_sessions(layout)
+    subjects = list(sessions_by_subject)
 
     # filter subject list
-    if isinstance(subject_list, list):
-        subjects = [s for s in subjects if s in subject_list]
-    elif isinstance(subject_list, dict):
-        subjects = [s for s in subjects if s in subject_list.keys()]
+    if isinstance(subject_list, (list, dict)):
+        wanted_subjects = set(subject_list)
+        subjects = [s for s in subjects if s in wanted_subjects]
 
     if skip_session:
       subsess = subjects
     else:  
       subsess = []
+      wanted_sessions = set(session_list) if session_list else None
       # filter session list
       for s in subjects:
-          sessions = layout.get_sessions(subject=s)
+          sessions = sessions_by_subject[s]
           if not sessions:
               print('WARNING: No sessions found for subject {}'.format(s))
-          elif session_list:
+          elif wanted_sessions:
               # Append tuple of subject and session only if the session is in the given session_list
-              subsess += [(s, session) for session in sessions if session in session_list]
+              subsess.extend((s, session) for session in sessions if session in wanted_sessions)
           else:
-              subsess += list(product([s], sessions))
+              subsess.extend((s, session) for session in sessions)
 
       assert len(subsess), 'bids data not found for participants. If labels ' \
               'were provided, check the participant labels for errors.  ' \
@@ -186,6 +324,15 @@ def read_bids_layout(layout, subject_list=None, session_list=None,skip_session=F
 
     return subsess
 
+def _positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('must be an integer, got {}'.format(value))
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be at least 1, got {}'.format(value))
+    return number
+
 def generate_parser(parser=None):
     """
     Generates the command line parser for this program.
@@ -226,42 +373,110 @@ def generate_parser(parser=None):
       help='Optional flag to skip sessions. Default is false.'
            'If set to true, the code will assume no sessions exist.'
     )    
+    parser.add_argument(
+        '--database-path', '--pybidsdb-dir', dest='database_path',
+        help='Optional directory in which to keep the pybids index of the bids '
+             'dataset. If it already holds an index from a previous run, that '
+             'index is reused instead of re-crawling the dataset. Keep this '
+             'directory between runs to benefit from it.'
+    )
+    parser.add_argument(
+        '--pybidsdb-reset', dest='reset_database', action='store_true',
+        help='Optional flag to rebuild the pybids index in --pybidsdb-dir, e.g. '
+             'after files were added to or removed from the bids dataset.'
+    )
+    parser.add_argument(
+        '--workers', dest='workers', type=_positive_int, default=os.cpu_count() or 1,
+        help='Optional number of subject/session pairings to run in parallel. '
+             'Default is the number of CPUs.'
+    )
     return parser
 
+# Only these strategies read sidecar metadata (SeriesNumber) through the layout
+METADATA_STRATEGIES = ('closest',)
+
+@lru_cache(maxsize=None)
+def _get_layout(bids_dir, index_metadata=True, database_path=None, subjects=None, reset_database=False):
+    # Indexed once per process; with a database_path the index is saved there and other processes just open it
+    # pybids is imported here rather than at the top so --help and argument errors do not pay for it
+    from bids import BIDSLayout, BIDSLayoutIndexer
+    from bids.layout.validation import DEFAULT_LOCATIONS_TO_IGNORE
+
+    if database_path:
+        # An index built without metadata cannot serve a metadata strategy later, so keep the two apart
+        database_path = os.path.join(database_path, 'metadata' if index_metadata else 'no_metadata')
+    ignore = None
+    if subjects:
+        # Leave every other subject's directory out of the index; the root stays the same so relative paths do not change
+        other_subjects = re.compile(r'^/sub-(?!(?:{})(?:/|$))'.format('|'.join(map(re.escape, subjects))))
+        ignore = list(DEFAULT_LOCATIONS_TO_IGNORE) + [other_subjects]
+    # BIDSLayoutIndexer defaults to validate=False, unlike BIDSLayout's own indexer, so ask for validation explicitly
+    return BIDSLayout(bids_dir, database_path=database_path, reset_database=reset_database,
+                      indexer=BIDSLayoutIndexer(validate=True, index_metadata=index_metadata, ignore=ignore))
+
+def _process_one(layout_args, subject, session, strategy, skip_session=False):
+    layout = _get_layout(*layout_args)
+    root_prefix = layout.root + '/'
+    prefix_len = len(root_prefix)
+    try:
+        x = FieldmapPairing(layout, subject, session, strategy, skip_session=skip_session)
+        for fieldmap, functional_list in x.pairing.items():
+            rel_functional_list = [f[prefix_len:] if f.startswith(root_prefix) else f for f in functional_list]
+            if skip_session:
+                # Drop the leading sub-<label>/ directory
+                rel_functional_list = [f[f.find(os.path.sep) + 1:] for f in rel_functional_list]
+            print(fieldmap, 'IntendedFor',rel_functional_list)
+            x.insert_edit_json(fieldmap, 'IntendedFor',rel_functional_list)
+    except Exception as e:
+        print("Error finding {}, {}.".format(subject, session), e)
+
+    # Write this subject/session's edits now; in a pool worker the sidecar cache is not visible to main()
+    flush_json_cache()
+
 def main(argv=sys.argv):
     parser = generate_parser()
     args = parser.parse_args()
+    if args.reset_database and not args.database_path:
+        parser.error('--pybidsdb-reset requires --pybidsdb-dir')
 
     bids_dir = args.bids_dir
-    layout = BIDSLayout(bids_dir)
-
-    # Create a list of tuples for all subjects and sessions
-    subsess = read_bids_layout(layout, subject_list=args.subject_list, session_list=args.session_list,skip_session=args.skip_session)
-
     strategy = args.strategy
     skip_session = args.skip_session
-    if skip_session:
-      for subject in subsess:
-        session = None
-        try:
-          x = FieldmapPairing(layout, subject, session, strategy,skip_session=skip_session)
-          for fieldmap, functional_list in x.pairing.items():
-            rel_functional_list = [f.replace(layout.root + '/', '') for f in functional_list]
-            rel_functional_list_nosub = [os.path.join(*(f.split(os.path.sep)[1:])) for f in rel_functional_list]
-            print(fieldmap, 'IntendedFor',rel_functional_list_nosub)
-            x.insert_edit_json(fieldmap, 'IntendedFor',rel_functional_list_nosub)
-        except Exception as e:
-          print("Error finding {}, {}.".format(subject, session), e)    
-    else:
-      for subject,session in subsess:
-        try:
-            x = FieldmapPairing(layout, subject, session, strategy)
-            for fieldmap, functional_list in x.pairing.items():
-                rel_functional_list = [f.replace(layout.root + '/', '') for f in functional_list]
-                print(fieldmap, 'IntendedFor',rel_functional_list)
-                x.insert_edit_json(fieldmap, 'IntendedFor',rel_functional_list)
-        except Exception as e:
-            print("Error finding {}, {}.".format(subject, session), e)
+    # A persistent index must cover the whole dataset, otherwise only index the requested participants
+    subjects = None if args.database_path or not args.subject_list else tuple(sorted(args.subject_list))
+
+    # Without --database-path the index is saved to a scratch database for this run only, so pool workers can
+    # still open it instead of crawling the dataset again
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        database_path = args.database_path or scratch_dir
+        # Skip parsing every json sidecar into the index unless the strategy needs it
+        layout_args = (bids_dir, strategy in METADATA_STRATEGIES, database_path, subjects)
+        if args.reset_database:
+            # Workers are handed layout_args without the reset, so they open the index rebuilt here instead of rebuilding it again
+            layout = _get_layout(*layout_args, reset_database=True)
+        else:
+            # Called exactly as _process_one calls it, so a serial run reuses this lru_cache entry
+            layout = _get_layout(*layout_args)
+
+        # Create a list of tuples for all subjects and sessions
+        subsess = read_bids_layout(layout, subject_list=args.subject_list, session_list=args.session_list,skip_session=skip_session)
+        if skip_session:
+          subsess = [(subject, None) for subject in subsess]
+
+        # Never start more workers than there are subject/sessions to pair
+        max_workers = min(args.workers, len(subsess))
+        if max_workers <= 1:
+            # Nothing to overlap; reuse the layout already open in this process
+            for subject, session in subsess:
+                _process_one(layout_args, subject, session, strategy, skip_session)
+        else:
+            # Every subject/session reads and writes its own fmap sidecars, so they can be paired in parallel
+            # Workers are spawned rather than forked so no SQLite connection crosses fork(); each opens the saved index
+            # lazily on its first task
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(_process_one, layout_args, subject, session, strategy, skip_session) for subject, session in subsess]
+                for future in as_completed(futures):
+                    future.result()
 
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file